@@ -1,8 +1,18 @@
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import os
+import math
 import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 from matplotlib import pyplot as plt
+from tqdm import tqdm
+
+# columns holding timestamps, all other columns of the cleaned csv files are numeric measurements
+time_columns = ['time', 'time_sec']
 
 files_kbm = ["stabilus", "stadtkehl", "wasserwerke-a", "wasserwerke-b", "piaggio", "gummipumpe", "pumpe-v2", "pumpe-v3"]
 
@@ -21,6 +31,12 @@ anomalies_kbm = {'stabilus': ["17/06/19 10:22:00",
                               "5/25/18 18:35"]}
 
 
+def _scan_files(dir_path):
+    """ Returns the entries of all files in a directory, sorted by name to get a deterministic order. """
+
+    return sorted((entry for entry in os.scandir(dir_path) if entry.is_file()), key=lambda entry: entry.name)
+
+
 class DataPipeKBM:
     def __init__(self, import_path: str, export_path: str):
         self.import_path = import_path
@@ -35,10 +51,10 @@ class DataPipeKBM:
         """
 
         # iterate over all files from import_path directory
-        for file in os.scandir(self.import_path):
+        for file in _scan_files(self.import_path):
 
             # read original csv file
-            df = pd.read_csv(file, sep=',')
+            df = pd.read_csv(file.path, sep=',', memory_map=True)
 
             # extract the temperature from the tags column and remove overhang from the tags column
             if split_tags:
@@ -49,7 +65,7 @@ class DataPipeKBM:
             df = df.sort_values(by=['time'])
 
             # add a column with the time in seconds to unify measurements, and a column for anomaly values
-            df['time_sec'] = df['time'].apply(lambda x: x.split('.')[0])
+            df['time_sec'] = df['time'].str.split('.', n=1).str[0]
 
             # keep only time and measurement values
             df = df[['vibration-x', 'vibration-y', 'vibration-z', 'temperature', 'time', 'time_sec']]
@@ -63,22 +79,33 @@ class DataPipeKBM:
     def check_data_quality(self):
 
         # iterate over all file names
-        for file in os.scandir(self.import_path):
+        for file in _scan_files(self.import_path):
 
             # read csv file from path
             path = f"{self.export_path}/{file.name}_full.csv"
-            df = pd.read_csv(path)
+            df = pd.read_csv(path, usecols=['time_sec'], memory_map=True)
+
+            # check the number of samples per timestamp and timestamps that are directly adjacent (in file order)
+            times = pd.to_datetime(df['time_sec'].drop_duplicates(), format='%Y-%m-%d %H:%M:%S')
+            time_difs = times.diff()
+            problematic = (time_difs < pd.Timedelta(0)) | (time_difs == pd.Timedelta(seconds=1))
+            for time, time_dif in zip(times[problematic], time_difs[problematic]):
+                print(file.name, time.to_pydatetime(), time_dif.to_pytimedelta())
+
 
-            # check the number of samples per timestamp and timestamps that are directly adjacent
-            old_time = datetime.datetime.now() - datetime.timedelta(days=100000)
-            for time_str in df['time_sec'].unique():
-                time = datetime.datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
-                time_dif = time - old_time
-                old_time = time
-                if time_dif < datetime.timedelta(seconds=0):
-                    print(file.name, time, time_dif)
-                elif time_dif == datetime.timedelta(seconds=1):
-                    print(file.name, time, time_dif)
+def _read_bearing_file(path):
+    """ Reads one tab separated file of the bearing dataset as numpy array, using the pyarrow parser. """
+
+    # the files are small and already read in parallel processes, so pyarrow's own threads would only compete
+    # the values are parsed as float32, which is precise enough and halves the memory (missing columns are ignored)
+    # the file is memory mapped, so the parser reads straight from the page cache instead of a copied buffer
+    column_types = {f"f{i}": pa.float32() for i in range(8)}
+    with pa.memory_map(path) as source:
+        table = pacsv.read_csv(source,
+                               read_options=pacsv.ReadOptions(autogenerate_column_names=True, use_threads=False),
+                               parse_options=pacsv.ParseOptions(delimiter='\t'),
+                               convert_options=pacsv.ConvertOptions(column_types=column_types))
+    return np.column_stack([column.to_numpy() for column in table.columns])
 
 
 class DataPipeBearingTest:
@@ -102,15 +129,16 @@ class DataPipeBearingTest:
         The files contain one or multiple features from multiple bearings that were being tested simultaneously.
         """
 
-        # get all files from the path and concatenate them to a single csv file
-        for file in os.scandir(self.import_path):
-            df = pd.read_csv(f"{self.import_path}/{file.name}", sep='\t', header=None)
-            df['time_sec'] = datetime.datetime.strptime(file.name, '%Y.%m.%d.%H.%M.%S')
-            df.to_csv(self.export_path + "_full.csv", mode='a', index=False, header=False)  # must not exist yet!!
+        # get all files from the path (in chronological order by their names) and read them in parallel
+        files = _scan_files(self.import_path)
+        times = [datetime.datetime.strptime(file.name, '%Y.%m.%d.%H.%M.%S') for file in files]
+        with ProcessPoolExecutor() as executor:
+            arrays = list(tqdm(executor.map(_read_bearing_file, [file.path for file in files], chunksize=16),
+                               total=len(files), desc="Reading files"))
 
-        # read csv file from path and add column names to use the time later
-        df = pd.read_csv(self.export_path + "_full.csv", header=None)
-        df.columns = ["Vibration-" + str(i) for i in range(df.shape[1] - 1)] + ['time_sec']
+        # concatenate them to a single dataframe, add column names to use the time later and write it at once
+        df = pd.DataFrame(np.concatenate(arrays), columns=["Vibration-" + str(i) for i in range(arrays[0].shape[1])])
+        df['time_sec'] = np.repeat(times, [len(array) for array in arrays])
         df.to_csv(self.export_path + "_full.csv", index=False)
 
     def plot_data(self):
@@ -136,59 +164,199 @@ class DataPipeBearingTest:
             plt.show()
 
 
+def _block_mean(array, starts, axis=0):
+    """
+    Averages the blocks of an array that begin at the given start indices along axis, in a single pass.
+
+    Missing values (NaN) are skipped, same as in a pandas mean. A block without any values is NaN.
+    """
+
+    # sum up the blocks in place of the (possibly non-contiguous) array, without a reshaped copy
+    # only if values are missing, they are summed as zeros and every block is divided by its count of present values
+    missing = np.isnan(array)
+    if missing.any():
+        sums = np.add.reduceat(np.where(missing, 0, array), starts, axis=axis)
+        counts = np.add.reduceat(~missing, starts, axis=axis, dtype=np.int64).astype(sums.dtype)
+        with np.errstate(invalid='ignore'):
+            return sums / counts
+
+    sums = np.add.reduceat(array, starts, axis=axis)
+    lengths = np.diff(starts, append=array.shape[axis]).astype(sums.dtype)
+    return sums / np.expand_dims(lengths, [i for i in range(array.ndim) if i != axis % array.ndim])
+
+
+def _chunk_mean(array, chunk_size):
+    """
+    Averages every block of chunk_size consecutive rows of a 2d array.
+
+    A trailing block with less than chunk_size rows is averaged on its own and missing values are skipped, same as a
+    groupby on index // chunk_size followed by mean().
+    """
+
+    return _block_mean(array, np.arange(0, array.shape[0], chunk_size), axis=0)
+
+
+def _split_mean(array, sections, axis=-1):
+    """ Averages each of the sections that np.array_split(array, sections, axis) would return, without splitting. """
+
+    # same as array_split, the first (length % sections) sections get one element more than the others
+    size, extras = divmod(array.shape[axis], sections)
+    lengths = [size + 1] * extras + [size] * (sections - extras)
+    return _block_mean(array, np.cumsum([0] + lengths[:-1]), axis=axis)
+
+
+def _parquet_file(csv_path):
+    """
+    Opens the parquet copy of a csv file, which is much faster to read than the csv itself.
+
+    The copy is (re)built next to the csv, streaming it batch by batch, if it does not exist, is older than the csv or
+    has other column types. The time columns are stored as strings and all other columns as float32, decided by name
+    and not by type inference, which only sees the first block (e.g. a column empty there would be inferred as null).
+    """
+
+    # the header is enough to get the column names and their types
+    with pa.memory_map(csv_path) as source, pacsv.open_csv(source) as reader:
+        column_types = {name: pa.string() if name in time_columns else pa.float32() for name in reader.schema.names}
+
+    parquet_path = f"{os.path.splitext(csv_path)[0]}.parquet"
+    if (not os.path.exists(parquet_path) or os.path.getmtime(parquet_path) < os.path.getmtime(csv_path)
+            or not pq.read_schema(parquet_path).equals(pa.schema(column_types), check_metadata=False)):
+        print(f"Converting {csv_path} to parquet")
+        convert_options = pacsv.ConvertOptions(column_types=column_types)
+
+        # write to a temporary file first, so an interrupted conversion is never picked up as up to date
+        with pa.memory_map(csv_path) as source, pacsv.open_csv(source, convert_options=convert_options) as reader:
+            with pq.ParquetWriter(f"{parquet_path}.tmp", reader.schema, compression='snappy') as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+        os.replace(f"{parquet_path}.tmp", parquet_path)
+
+    return pq.ParquetFile(parquet_path, memory_map=True)
+
+
+class _StreamingMean:
+    """
+    Averages every block of factor consecutive rows of an array that arrives in chunks, and writes the means to a csv.
+
+    Rows of an incomplete block at the end of a chunk are kept and completed by the next chunk, so the chunks can have
+    any size. The trailing incomplete block of the data is averaged on its own, same as in _chunk_mean.
+
+    Used as context manager, the file is always closed on exit and removed again if the stream failed.
+    """
+
+    def __init__(self, path, factor, columns):
+        self.path = path
+        self.factor = factor
+        self.columns = columns
+        self.rest = None
+        self.file = open(path, 'w', newline='')
+        pd.DataFrame(columns=columns).to_csv(self.file, index=False)
+
+    def add(self, array):
+
+        # complete the pending block of the last chunk with the first rows of this one (copying less than factor rows)
+        start = 0
+        if self.rest is not None and len(self.rest) > 0:
+            start = min(self.factor - len(self.rest), array.shape[0])
+            block = np.concatenate([self.rest, array[:start]])
+            if len(block) < self.factor:
+                self.rest = block
+                return
+            self._write(_chunk_mean(block, self.factor))
+
+        # average the whole blocks of the chunk on a view of the shared array and only copy its incomplete tail
+        num_full = start + ((array.shape[0] - start) // self.factor) * self.factor
+        self.rest = array[num_full:].copy()
+        self._write(_chunk_mean(array[start:num_full], self.factor))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None and self.rest is not None and len(self.rest) > 0:
+                self._write(_chunk_mean(self.rest, self.factor))
+        finally:
+            self.file.close()
+            if exc_type is not None:
+                os.remove(self.path)
+
+    def _write(self, means):
+        pd.DataFrame(means, columns=self.columns).to_csv(self.file, header=False, index=False)
+
+
 class Resampler:
-    def __init__(self, directory_path, new_sampling_rate, feature_cols_tuple):
+    def __init__(self, directory_path, new_sampling_rates, feature_cols_tuple):
         self.directory_path = directory_path
-        self.new_sampling_rate = new_sampling_rate
+        self.new_sampling_rates = new_sampling_rates
         self.feature_cols_tuple = feature_cols_tuple
         self.old_sampling_rate = 20480 if 'bearing' in self.directory_path else 800
 
     def resample_all_csv_in_directory(self):
         """
-        Resample all files in a folder to a new sampling rate.
+        Resample all files in a folder to the new sampling rates, reading every file only once for all rates.
 
         The files need to be all of the same type (bearing or kbm) and have the same column names!
-
-        :param new_sampling_rate: number of samples to resample to
         """
 
         # iterate over all files in folder
         for file in os.listdir(self.directory_path):
             if file.endswith("_full.csv"):
-                print(f"Resampling {file} Rate: {self.new_sampling_rate}")
+                print(f"Resampling {file} Rates: {self.new_sampling_rates}")
                 self.resample_csv(file_path=f"{self.directory_path}/{file.replace('_full.csv', '')}")
 
     def resample_csv(self, file_path):
 
-        # load data from file as dataframe
-        df = pd.read_csv(f"{file_path}_full.csv")
-
-        # drop the ending rows not dividable by original sampling rate
-        if 'kbm' in file_path:
-            df = df.iloc[:-(len(df) % self.old_sampling_rate)]
-
-        # delete resample file if another already exists
-        save_path = f"{file_path}_{self.new_sampling_rate}.csv"
-        if os.path.exists(save_path):
-            print("Delete old")
-            os.remove(save_path)
-
-        temp_df = df.iloc[:,:-1]
-        factor = self.old_sampling_rate // self.new_sampling_rate
-        avg_df = temp_df.groupby(df.index // factor)
-        avg_df = avg_df.mean()
-        print(avg_df)
-
-        avg_df.to_csv(save_path, index=False)
+        # only resample to the rates whose resampled file is missing or older than the data, others are up to date
+        full_path = f"{file_path}_full.csv"
+        save_paths = {rate: f"{file_path}_{rate}.csv" for rate in self.new_sampling_rates}
+        rates = [rate for rate, save_path in save_paths.items()
+                 if not os.path.exists(save_path) or os.path.getmtime(save_path) < os.path.getmtime(full_path)]
+        if not rates:
+            print("Up to date")
+            return
+
+        # only read the numeric feature columns (all but the time columns) from the parquet copy of the data
+        with _parquet_file(full_path) as parquet_file:
+            features = [name for name in parquet_file.schema_arrow.names if name not in time_columns]
+
+            # drop the ending rows not dividable by original sampling rate
+            num_rows = parquet_file.metadata.num_rows
+            if 'kbm' in file_path:
+                num_rows -= num_rows % self.old_sampling_rate
+
+            # stream the data once in chunks of ~1M rows and average every chunk for all rates
+            # the averagers only read the shared chunk and numpy releases the GIL while reducing,
+            # so the threads run in parallel
+            chunk_size = 2 ** 20
+            remaining_rows = num_rows
+            batches = parquet_file.iter_batches(batch_size=chunk_size, columns=features)
+            with ExitStack() as stack, ThreadPoolExecutor(max_workers=len(rates)) as executor:
+
+                # write to temporary files first, which are removed again if anything fails
+                averagers = [stack.enter_context(_StreamingMean(f"{save_paths[rate]}.tmp",
+                                                                self.old_sampling_rate // rate, features))
+                             for rate in rates]
+
+                for batch in tqdm(batches, total=math.ceil(num_rows / chunk_size), desc="Resampling chunks"):
+                    batch = batch.slice(0, remaining_rows)
+                    remaining_rows -= batch.num_rows
+                    if batch.num_rows == 0:
+                        break
+                    array = np.column_stack([column.to_numpy(zero_copy_only=False) for column in batch.columns])
+                    list(executor.map(lambda averager: averager.add(array), averagers))
+
+        # only complete results replace the resampled files, an interrupted run never leaves a seemingly up to date one
+        for rate in rates:
+            os.replace(f"{save_paths[rate]}.tmp", save_paths[rate])
 
 
 def _resample_all_to_defaults(resample_rates):
-    for i in resample_rates:
-        # Resampler(directory_path='data/kbm', new_sampling_rate=i, feature_cols_tuple=(2, 6)).resample_all_csv_in_directory()
-        Resampler(directory_path='data/bearing',
-                  new_sampling_rate=i,
-                  feature_cols_tuple=(0, 4)
-                  ).resample_all_csv_in_directory()
+    # Resampler(directory_path='data/kbm', new_sampling_rates=resample_rates, feature_cols_tuple=(2, 6)).resample_all_csv_in_directory()
+    Resampler(directory_path='data/bearing',
+              new_sampling_rates=resample_rates,
+              feature_cols_tuple=(0, 4)
+              ).resample_all_csv_in_directory()
 
 
 def restructure_data(dir_path):
@@ -198,41 +366,34 @@ def restructure_data(dir_path):
     files = [f for f in os.listdir(dir_path) if f.endswith("2_1000.csv")]
     for file in files:
         if file.endswith("1_1000.csv"):
-            df = pd.read_csv(f"{dir_path}/{file}", usecols=[0,2,4,6])
+            df = pd.read_csv(f"{dir_path}/{file}", usecols=[0,2,4,6], memory_map=True)
         else:
-            df = pd.read_csv(f"{dir_path}/{file}", usecols=[0,1,2,3])
+            df = pd.read_csv(f"{dir_path}/{file}", usecols=[0,1,2,3], memory_map=True)
 
 
-        # iterate over all columns and concatenate them to a single list
-        data = []
-        for i in range(df.shape[1]):
-            data.extend(df.iloc[:, i])
-        # round to 4 decimals
-        data = [round(i, 4) for i in data]
-        # save as csv
+        # concatenate all columns to a single one and round to 4 decimals
+        data = np.round(df.to_numpy().ravel(order='F'), 4)
+        # save as csv, with all rows formatted and written at once
         with open(f"{dir_path}/{file.replace('_','_COL-')}", "w") as f:
             f.write("Vibration\n")
-            for i in data:
-                f.write(str(i) + ",\n")
+            f.write("".join(f"{i},\n" for i in data.tolist()))
 
 
 if __name__ == '__main__':
 
     file_path = "data/bearing_experiment-3"
-    # load data from file as dataframe
-    df = pd.read_csv(f"{file_path}/full.csv")
-    print(len(df) // 20480)
-    save_path = f"{file_path}/1000-NEW.csv"
-    # store columns in list
-    columns = df.columns.tolist()[:-1]
+    # load the feature columns (all but the time columns) from the parquet copy of the data, without a dataframe
+    with _parquet_file(f"{file_path}/full.csv") as parquet_file:
+        columns = [name for name in parquet_file.schema_arrow.names if name not in time_columns]
+        table = parquet_file.read(columns=columns)
     len_columns = len(columns)
+    print(table.num_rows // 20480)
+    save_path = f"{file_path}/1000-NEW.csv"
 
-    array = df.iloc[:, :-1].to_numpy().T
-    array = array.reshape(array.shape[0], -1, 20480)
-    split_list = [np.array_split(array[i][j], 1000) for i in range(array.shape[0]) for j in range(array.shape[1])]
-    split_list = [split_list[i][j].mean() for i in range(len(split_list)) for j in range(len(split_list[i]))]
-    split_array = np.array(split_list)
-    split_array = split_array.reshape(len_columns, -1, 1000)
+    # stack the columns to one array of shape (columns, measurements, samples), averaged in float64 as before
+    array = np.stack([column.to_numpy() for column in table.columns], dtype=np.float64)
+    array = array[:, :(array.shape[1] // 20480) * 20480].reshape(len_columns, -1, 20480)
+    split_array = _split_mean(array, 1000)
     split_df = pd.DataFrame(split_array.reshape(len_columns, -1).T, columns=columns)
 
     # plot all four columns